@@ -1,22 +1,84 @@
 import os
 import csv
-import requests
+import httpx
 import pandas as pd
 import io
-from datetime import datetime
+import threading
+import time
 import urllib.parse
-import openpyxl
-from openpyxl.styles import PatternFill
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import xlsxwriter
+from xlsxwriter.utility import xl_col_to_name
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import re
+import zlib
+
+# A well-formed list of 1-5 digit SIC codes, and the characters allowed at all
+_SIC_LIST_RE = re.compile(r'^\s*\d{1,5}(?:\s*,\s*\d{1,5})*\s*$')
+_SIC_CHARS_RE = re.compile(r'^[\d\s,]+$')
+
+# Cap concurrent downloads to stay polite to the Companies House service
+MAX_DOWNLOAD_WORKERS = 8
+
+# Only these columns are used downstream, the rest are skipped at parse time
+REQUIRED_COLS = ['company_name', 'company_number', 'company_status', 'registered_office_address', 'dissolution_date']
+
+# Declared dtypes for the columns we use, so read_csv skips type inference.
+# Text columns are Arrow-backed strings rather than one Python object per cell.
+CSV_DTYPES = {
+    'company_name': 'string[pyarrow]',
+    'company_number': 'string[pyarrow]',
+    'company_status': 'category',
+    'registered_office_address': 'string[pyarrow]',
+    'dissolution_date': 'string[pyarrow]',
+}
+
+# Rate limiting, transient server errors, timeouts and dropped connections are
+# retried with exponential backoff, or after Retry-After when the server sends one
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_AFTER_STATUSES = {429, 503}
+RETRY_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+@st.cache_resource
+def get_client():
+    """Shared HTTP/2 client, kept across reruns so pooled TLS connections are reused"""
+    return httpx.Client(
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=MAX_RETRIES,  # connection failures only
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16)
+        ),
+        timeout=httpx.Timeout(30, connect=5)
+    )
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying a response, honouring Retry-After on 429/503"""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and response.status_code in RETRY_AFTER_STATUSES:
+        if retry_after.strip().isdigit():
+            return int(retry_after)
+        try:
+            return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return RETRY_BACKOFF * 2 ** attempt
 
 def validate_sic_input(input_str):
     """Validate manually entered SIC codes"""
     if not input_str.strip():
         return False, "Input cannot be empty"
     
+    # Fast path: a well-formed list needs no per-code checks
+    if _SIC_LIST_RE.fullmatch(input_str):
+        return True, [code.strip() for code in input_str.split(',')]
+    
     # Check for invalid characters (only numbers, commas, and spaces allowed)
-    if not re.match(r'^[\d\s,]+$', input_str):
+    if not _SIC_CHARS_RE.match(input_str):
         return False, "Only numbers and commas are allowed"
     
     # Split and check individual codes
@@ -56,63 +118,137 @@ def read_keywords_from_file(file):
         st.error(f"Error reading parameters file: {e}")
         return []
 
-def download_csv_for_keyword(keyword):
-    """Download CSV for a specific keyword"""
-    try:
-        encoded_keyword = urllib.parse.quote(keyword)
-        url = f"https://find-and-update.company-information.service.gov.uk/advanced-search/download?companyNameIncludes=&companyNameExcludes=&registeredOfficeAddress=LE5&incorporationFromDay=&incorporationFromMonth=&incorporationFromYear=&incorporationToDay=&incorporationToMonth=&incorporationToYear=&sicCodes={encoded_keyword}&dissolvedFromDay=&dissolvedFromMonth=&dissolvedFromYear=&dissolvedToDay=&dissolvedToMonth=&dissolvedToYear="
-        response = requests.get(url)
-        response.raise_for_status()
-        df = pd.read_csv(io.StringIO(response.text))
-        return df
-    except Exception as e:
-        st.warning(f"Error downloading CSV for keyword {keyword}: {e}")
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=512)
+def download_csv_for_keyword(keyword, _client):
+    """Download CSV for a specific keyword, None if it has no rows (errors are raised and not cached)"""
+    encoded_keyword = urllib.parse.quote(keyword)
+    url = f"https://find-and-update.company-information.service.gov.uk/advanced-search/download?companyNameIncludes=&companyNameExcludes=&registeredOfficeAddress=LE5&incorporationFromDay=&incorporationFromMonth=&incorporationFromYear=&incorporationToDay=&incorporationToMonth=&incorporationToYear=&sicCodes={encoded_keyword}&dissolvedFromDay=&dissolvedFromMonth=&dissolvedFromYear=&dissolvedToDay=&dissolvedToMonth=&dissolvedToYear="
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = _client.get(url)
+        except RETRY_ERRORS:
+            # e.g. a read timeout, or a GOAWAY/reset failing every stream on the shared connection
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(retry_delay(None, attempt))
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            break
+        time.sleep(retry_delay(response, attempt))
+    response.raise_for_status()
+    body = response.content
+    # Many SIC codes match nothing and return just the header row
+    if body.rstrip(b'\r\n').count(b'\n') == 0:
         return None
+    df = pd.read_csv(io.BytesIO(body), engine='c', usecols=REQUIRED_COLS, dtype=CSV_DTYPES)
+    return df
 
-def process_dissolution_date(date_str):
-    """Process dissolution date string"""
-    if pd.isna(date_str) or date_str == '':
-        return None
-    try:
-        return datetime.strptime(date_str, '%d/%m/%Y')
-    except:
-        try:
-            return datetime.strptime(date_str, '%Y-%m-%d')
-        except:
-            return None
+def download_all_keywords(keywords, client, progress_bar):
+    """Download CSVs for all keywords concurrently, keyed by keyword"""
+    downloaded = {}
+    # Workers need the script run context, otherwise st.cache_data neither reads nor writes
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=min(MAX_DOWNLOAD_WORKERS, len(keywords)),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        futures = {executor.submit(download_csv_for_keyword, k, client): k for k in keywords}
+        for done, future in enumerate(as_completed(futures), start=1):
+            keyword = futures[future]
+            try:
+                downloaded[keyword] = future.result()
+            except Exception as e:
+                st.warning(f"Error downloading CSV for keyword {keyword}: {e}")
+                downloaded[keyword] = None
+            progress_bar.progress(done / len(keywords))
+    return downloaded
+
+def parse_dissolution_dates(series):
+    """Parse dissolution dates in either supported format, unparseable values become NaT"""
+    parsed = pd.to_datetime(series, format='%d/%m/%Y', errors='coerce')
+    return parsed.fillna(pd.to_datetime(series, format='%Y-%m-%d', errors='coerce'))
 
 def filter_and_append_data(input_df):
     """Filter data based on dissolution date"""
-    filtered_df = input_df[
-        (input_df['dissolution_date'].apply(process_dissolution_date).isna()) | 
-        (input_df['dissolution_date'].apply(process_dissolution_date) > datetime(2019, 1, 1))
-    ]
-    return filtered_df
+    parsed = parse_dissolution_dates(input_df['dissolution_date'])
+    mask = parsed.isna() | (parsed > pd.Timestamp('2019-01-01'))
+    # Keep the parsed dates so the stats don't have to parse them again
+    return input_df[mask].assign(_parsed_dissolution=parsed[mask])
 
 def process_company_stats(data_df):
     """Generate statistics about companies"""
+    counts = data_df.groupby('company_status', observed=True, sort=False).size()
     stats = {
-        'Active Companies': len(data_df[data_df['company_status'] == 'Active']),
-        'Dissolved Companies': len(data_df[data_df['company_status'] == 'Dissolved']),
-        'Companies in Liquidation': len(data_df[data_df['company_status'] == 'Liquidation'])
+        'Active Companies': int(counts.get('Active', 0)),
+        'Dissolved Companies': int(counts.get('Dissolved', 0)),
+        'Companies in Liquidation': int(counts.get('Liquidation', 0))
     }
     
-    data_df['dissolution_year'] = data_df['dissolution_date'].apply(
-        lambda x: process_dissolution_date(x).year if process_dissolution_date(x) else None
-    )
-    
-    dissolution_by_year = data_df[data_df['dissolution_year'].notna()]['dissolution_year'].value_counts().to_dict()
+    # Years come straight from the dates parsed during filtering
+    years = data_df['_parsed_dissolution'].dt.year.dropna().astype('int16')
+    dissolution_by_year = {int(year): int(count) for year, count in years.value_counts().items()}
     stats['Dissolution by Year'] = dissolution_by_year
     
     return stats
 
-def highlight_dissolved_rows(sheet, max_col):
-    """Highlight dissolved companies in a worksheet"""
-    red_fill = PatternFill(start_color='FFCCCB', end_color='FFCCCB', fill_type='solid')
-    for row in sheet.iter_rows(min_row=2, max_row=sheet.max_row, min_col=1, max_col=max_col):
-        if row[max_col - 1].value == 'Dissolved':
-            for cell in row:
-                cell.fill = red_fill
+def sic_sheet_name(sic_code):
+    """Deterministic Excel sheet name for a SIC code (max 31 chars, no special characters)"""
+    slug = re.sub(r'[^A-Za-z0-9_]', '_', str(sic_code))[:27]
+    if slug:
+        return 'SIC_' + slug
+    return f"SIC_{zlib.crc32(str(sic_code).encode()) & 0xffffffff:08x}"
+
+def highlight_dissolved_rows(sheet, red_format, status_col, max_row, max_col):
+    """Highlight dissolved companies in a worksheet with a single conditional formatting rule"""
+    sheet.conditional_format(1, 0, max_row, max_col, {
+        'type': 'formula',
+        'criteria': f'=${xl_col_to_name(status_col)}2="Dissolved"',
+        'format': red_format
+    })
+
+def write_dataframe_sheet(workbook, sheet_name, df, highlight_format=None):
+    """Write a DataFrame to a new worksheet row by row, as constant_memory mode requires"""
+    sheet = workbook.add_worksheet(sheet_name)
+    sheet.write_row(0, 0, list(df.columns))
+    for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        sheet.write_row(row_idx, 0, [None if pd.isna(value) else value for value in row])
+    if highlight_format is not None and not df.empty:
+        highlight_dissolved_rows(sheet, highlight_format, df.columns.get_loc('company_status'), len(df), df.shape[1] - 1)
+
+def build_excel_report(processed_sheets, stats, active_company_addresses):
+    """Build the Excel report in memory, flushing each row as it is written"""
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    red_format = workbook.add_format({'bg_color': '#FFCCCB'})
+    
+    # Write individual sheets for each processed SIC code, restoring one frame at a time
+    sheet_names = {}
+    row_counts = {}
+    for sic_code, sheet_bytes in processed_sheets.items():
+        df = pd.read_parquet(io.BytesIO(sheet_bytes))
+        sheet_name = sic_sheet_name(sic_code)
+        write_dataframe_sheet(workbook, sheet_name, df, highlight_format=red_format)
+        sheet_names[sic_code] = sheet_name
+        row_counts[sic_code] = len(df)
+    
+    # Master sheet indexes the SIC sheets rather than repeating their rows
+    master_sheet = workbook.add_worksheet('Master_Data')
+    master_sheet.write_row(0, 0, ['SIC Code', 'Companies'])
+    for row_idx, sic_code in enumerate(processed_sheets, start=1):
+        master_sheet.write_string(row_idx, 0, sic_code)
+        count = row_counts[sic_code]
+        master_sheet.write_formula(row_idx, 1, f'=HYPERLINK("#\'{sheet_names[sic_code]}\'!A1",{count})', None, count)
+    
+    # Write stats and addresses sheets
+    stats_sheet = workbook.add_worksheet('Stats')
+    stats_sheet.write_row(0, 0, ['Statistic', 'Value'])
+    for row_idx, (name, value) in enumerate(stats.items(), start=1):
+        stats_sheet.write_row(row_idx, 0, [name, str(value) if isinstance(value, dict) else value])
+    write_dataframe_sheet(workbook, 'Active_Addresses', active_company_addresses)
+    
+    workbook.close()
+    output.seek(0)
+    return output
 
 def main():
     st.title("Company Data Processor")
@@ -148,64 +284,55 @@ def main():
     
     if keywords:
         with st.spinner('Processing...'):
-            # Accumulated data
-            all_data = pd.DataFrame()
-            active_company_addresses = pd.DataFrame(columns=['company_name', 'registered_office_address'])
-            processed_sheets = {}  # To store processed data for each SIC code
+            # Frames to concatenate once after the loop
+            all_frames = []
+            # Unique (company_name, registered_office_address) pairs, in first-seen order
+            active_pairs = {}
+            processed_sheets = {}  # Parquet bytes of the processed data for each SIC code
             
-            # Process each keyword
+            # Download all keywords in parallel
             progress_bar = st.progress(0)
-            for idx, keyword in enumerate(keywords):
-                progress_bar.progress((idx + 1) / len(keywords))
-                
-                # Download CSV
-                keyword_df = download_csv_for_keyword(keyword)
+            downloaded = download_all_keywords(keywords, get_client(), progress_bar)
+            
+            # Process each keyword in input order
+            for keyword in keywords:
+                # Pop so each raw download can be freed once processed
+                keyword_df = downloaded.pop(keyword, None)
                 
                 if keyword_df is not None:
                     # Filter data
                     filtered_df = filter_and_append_data(keyword_df)
                     
-                    # Store processed data for this SIC code
-                    processed_sheets[keyword] = filtered_df
+                    # Store processed data for this SIC code as compressed bytes until the Excel write
+                    processed_sheets[keyword] = filtered_df.drop(columns='_parsed_dissolution').to_parquet(index=False)
                     
                     # Append to accumulated data
-                    all_data = pd.concat([all_data, filtered_df], ignore_index=True)
+                    all_frames.append(filtered_df)
                     
                     # Collect active company addresses
-                    active_addresses = filtered_df[filtered_df['company_status'] == 'Active'][['company_name', 'registered_office_address']]
-                    active_company_addresses = pd.concat([active_company_addresses, active_addresses], ignore_index=True)
+                    active_sub = filtered_df[filtered_df['company_status'] == 'Active']
+                    active_pairs.update(dict.fromkeys(zip(
+                        active_sub['company_name'].to_numpy(), active_sub['registered_office_address'].to_numpy()
+                    )))
+            
+            all_data = pd.concat(all_frames, ignore_index=True, copy=False) if all_frames else pd.DataFrame()
+            all_frames.clear()
+            active_company_addresses = pd.DataFrame(
+                list(active_pairs), columns=['company_name', 'registered_office_address']
+            )
             
             if not all_data.empty:
-                # Remove duplicates
-                all_data.drop_duplicates(inplace=True)
-                active_company_addresses.drop_duplicates(inplace=True)
+                # Per-keyword categories differ, so the concat falls back to object dtype
+                all_data['company_status'] = all_data['company_status'].astype('category')
+                
+                # Remove duplicates (company_number uniquely identifies a company)
+                all_data.drop_duplicates(subset=['company_number'], inplace=True, ignore_index=True)
                 
                 # Generate stats
                 stats = process_company_stats(all_data)
                 
                 # Create Excel file in memory
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    # Write individual sheets for each processed SIC code
-                    for sic_code, df in processed_sheets.items():
-                        # Clean sheet name to be valid Excel sheet name
-                        sheet_name = f"SIC_{sic_code}"[:31]  # Excel sheet names max 31 chars
-                        df.to_excel(writer, sheet_name=sheet_name, index=False)
-                        
-                        # Highlight dissolved companies in each sheet
-                        workbook = writer.book
-                        sheet = workbook[sheet_name]
-                        highlight_dissolved_rows(sheet, df.shape[1])
-                    
-                    # Write master data sheet
-                    all_data.to_excel(writer, sheet_name='Master_Data', index=False)
-                    highlight_dissolved_rows(writer.book['Master_Data'], all_data.shape[1])
-                    
-                    # Write stats and addresses sheets
-                    pd.DataFrame.from_dict(stats, orient='index').to_excel(writer, sheet_name='Stats')
-                    active_company_addresses.to_excel(writer, sheet_name='Active_Addresses', index=False)
-                
-                output.seek(0)
+                output = build_excel_report(processed_sheets, stats, active_company_addresses)
                 
                 # Show results
                 st.success("Processing complete!")
@@ -230,7 +357,7 @@ def main():
                 
                 # Show previews
                 st.subheader("Preview of Master Data")
-                st.dataframe(all_data.head())
+                st.dataframe(all_data.drop(columns='_parsed_dissolution').head())
                 
                 st.subheader("Preview of Active Company Addresses")
                 st.dataframe(active_company_addresses.head())